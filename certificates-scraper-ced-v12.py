@@ -6,12 +6,21 @@ Version 12 - Basato su analisi diretta HTML
 Estrae dati certificati dalla struttura HTML reale del sito.
 """
 
+import asyncio
+import functools
 import json
+import logging
+import os
 import re
 import sys
+import time
 from datetime import datetime
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
 from bs4 import BeautifulSoup
+from scraper_common import HtmlCache, PageFetcher, RateLimiter, block_resources, has_marker
+
+# Traccia per certificato: visibile solo con -v (default WARNING, solo errori)
+logger = logging.getLogger(__name__)
 
 # Configurazione
 CONFIG = {
@@ -20,6 +29,13 @@ CONFIG = {
     "detail_url": "https://www.certificatiederivati.it/db_bs_scheda_certificato.asp?isin=",
     "max_certificates": 200,
     "page_timeout": 30000,
+    "selector_timeout": 10000,
+    "concurrency": 8,  # Worker in parallelo, ognuno con una pagina propria
+    "requests_per_second": 4,  # Limite complessivo verso il sito, condiviso dai worker
+    "cache_dir": "data/cache",  # HTML schede per ISIN, riusato tra run
+    "cache_ttl": 86400,
+    "isins_file": "data/isins.json",  # ISIN visti nei run precedenti, con l'ultima data in lista
+    "isins_max_age": 30 * 86400,  # Dimentica gli ISIN assenti dalla lista da più di 30 giorni
     "output_file": "certificates-data.json"
 }
 
@@ -45,18 +61,36 @@ TARGET_UNDERLYINGS = [
     "NIKKEI", "HANG SENG", "RUSSELL"
 ]
 
+# Chiavi maiuscole precalcolate per is_target_underlying (anche basket/indici)
+TARGET_KEYWORDS = tuple(target.upper() for target in TARGET_UNDERLYINGS) + ("BASKET", "INDICI")
+TARGET_KEYWORD_SET = frozenset(TARGET_KEYWORDS)
+
+# Testo presente solo se la scheda arriva già completa dal server
+CERTIFICATE_MARKER = "Scheda Sottostante"
+
+# Numeri in formato italiano ("1.234,5" -> "1234.5", "12,5%" -> "12.5") in un solo passaggio
+IT_NUMBER_TABLE = str.maketrans({'.': None, ',': '.'})
+IT_PERCENT_TABLE = str.maketrans({'%': None, ',': '.'})
+
+# Pattern compilati una sola volta
+ISIN_HREF_RE = re.compile(r'isin=([A-Z]{2}[A-Z0-9]{10})')
+SCHEDA_EMITTENTE_RE = re.compile(r'Scheda Emittente', re.IGNORECASE)
+SCHEDA_SOTTOSTANTE_RE = re.compile(r'Scheda Sottostante', re.IGNORECASE)
+BARRIER_JS_RE = re.compile(r'barriera:\s*["\'](\d+(?:[.,]\d+)?)\s*(?:&nbsp;)?%["\']')
+LEVEL_JS_RE = re.compile(r'livello:\s*["\'](\d+(?:[.,]\d+)?)["\']')
+TYPE_JS_RE = re.compile(r'tipo:\s*["\'](\w+)["\']')
+# Chiave minuscola come le altre, case-insensitive solo sul valore (tiene la ricerca veloce per prefisso)
+REACHED_JS_RE = re.compile(r'raggiunta:\s*["\']?((?i:true|false))["\']?')
+
+@functools.lru_cache(maxsize=4096)
 def is_target_underlying(text):
     """Verifica se il testo contiene un sottostante target"""
     if not text:
         return False
     text_upper = text.upper()
-    for target in TARGET_UNDERLYINGS:
-        if target.upper() in text_upper:
-            return True
-    # Check anche per "basket" o "indici"
-    if "BASKET" in text_upper or "INDICI" in text_upper:
+    if text_upper in TARGET_KEYWORD_SET:
         return True
-    return False
+    return any(keyword in text_upper for keyword in TARGET_KEYWORDS)
 
 
 def extract_barrier_from_js(html_content):
@@ -69,43 +103,45 @@ def extract_barrier_from_js(html_content):
     }
     
     # Pattern per barriera: "50&nbsp;%" o "50 %"
-    barrier_match = re.search(r'barriera:\s*["\'](\d+(?:[.,]\d+)?)\s*(?:&nbsp;)?%["\']', html_content)
+    barrier_match = BARRIER_JS_RE.search(html_content)
     if barrier_match:
         barrier_data["percentage"] = float(barrier_match.group(1).replace(',', '.'))
     
     # Pattern per livello: "665,855" o "665.855"
-    level_match = re.search(r'livello:\s*["\'](\d+(?:[.,]\d+)?)["\']', html_content)
+    level_match = LEVEL_JS_RE.search(html_content)
     if level_match:
         barrier_data["level"] = float(level_match.group(1).replace(',', '.'))
     
     # Pattern per tipo: "DISCRETA" o "CONTINUA"
-    type_match = re.search(r'tipo:\s*["\'](\w+)["\']', html_content)
+    type_match = TYPE_JS_RE.search(html_content)
     if type_match:
         barrier_data["type"] = type_match.group(1)
     
     # Pattern per raggiunta: "true" o "false"
-    reached_match = re.search(r'raggiunta:\s*["\']?(true|false)["\']?', html_content, re.IGNORECASE)
+    reached_match = REACHED_JS_RE.search(html_content)
     if reached_match:
         barrier_data["reached"] = reached_match.group(1).lower() == "true"
     
     return barrier_data
 
 
-def extract_certificate_data(page, isin):
+detail_fetcher = PageFetcher(
+    has_marker(CERTIFICATE_MARKER),
+    f'h3:has-text("{CERTIFICATE_MARKER}")',  # Pannello sottostanti
+    CONFIG["page_timeout"],
+    CONFIG["selector_timeout"],
+    rate_limiter=RateLimiter(CONFIG["requests_per_second"]),
+    cache=HtmlCache(CONFIG["cache_dir"], CONFIG["cache_ttl"])
+)
+
+
+async def extract_certificate_data(context, page, isin):
     """Estrae tutti i dati da una pagina certificato"""
-    print(f"  📄 Extracting data for {isin}...")
-    
-    url = f"{CONFIG['detail_url']}{isin}"
+    logger.debug("  📄 Extracting data for %s...", isin)
     
     try:
-        page.goto(url, timeout=CONFIG["page_timeout"])
-        page.wait_for_load_state("networkidle")
-        
-        # Aspetta che la pagina carichi
-        page.wait_for_timeout(1500)
-        
-        html = page.content()
-        soup = BeautifulSoup(html, 'html.parser')
+        html = await detail_fetcher.fetch(context, page, f"{CONFIG['detail_url']}{isin}", isin)
+        soup = BeautifulSoup(html, 'lxml')
         
         cert = {
             "isin": isin,
@@ -132,10 +168,9 @@ def extract_certificate_data(page, isin):
         
         # 2. TABELLA PRINCIPALE (ISIN, Mercato, Date)
         for table in soup.find_all('table', class_='table'):
-            rows = table.find_all('tr')
-            for row in rows:
-                th = row.find('th')
-                td = row.find('td')
+            for row in table.find_all('tr'):
+                th = row.th
+                td = row.td
                 if th and td:
                     label = th.get_text(strip=True).upper()
                     value = td.get_text(strip=True)
@@ -150,7 +185,7 @@ def extract_certificate_data(page, isin):
                         cert["currency"] = value
                     elif "NOMINALE" in label:
                         try:
-                            cert["nominal"] = float(value.replace('.', '').replace(',', '.'))
+                            cert["nominal"] = float(value.translate(IT_NUMBER_TABLE))
                         except:
                             pass
                     elif "TRIGGER" in label:
@@ -160,7 +195,7 @@ def extract_certificate_data(page, isin):
                             pass
         
         # 3. EMITTENTE - dalla sezione "Scheda Emittente"
-        emittente_panel = soup.find('h3', string=re.compile(r'Scheda Emittente', re.IGNORECASE))
+        emittente_panel = soup.find('h3', string=SCHEDA_EMITTENTE_RE)
         if emittente_panel:
             parent_panel = emittente_panel.find_parent('div', class_='panel')
             if parent_panel:
@@ -187,7 +222,7 @@ def extract_certificate_data(page, isin):
                                     break
         
         # 4. SOTTOSTANTI - dalla sezione "Scheda Sottostante"
-        sottostante_panel = soup.find('h3', string=re.compile(r'Scheda Sottostante', re.IGNORECASE))
+        sottostante_panel = soup.find('h3', string=SCHEDA_SOTTOSTANTE_RE)
         if sottostante_panel:
             # Estrai tipo basket dall'header
             header_text = sottostante_panel.get_text(strip=True)
@@ -211,7 +246,7 @@ def extract_certificate_data(page, isin):
                             # Strike
                             if len(cells) >= 2:
                                 try:
-                                    strike_text = cells[1].get_text(strip=True).replace('.', '').replace(',', '.')
+                                    strike_text = cells[1].get_text(strip=True).translate(IT_NUMBER_TABLE)
                                     underlying["strike"] = float(strike_text) if strike_text else None
                                 except:
                                     pass
@@ -220,7 +255,7 @@ def extract_certificate_data(page, isin):
                                 weight_text = cells[2].get_text(strip=True)
                                 if weight_text and weight_text != '\xa0':
                                     try:
-                                        underlying["weight"] = float(weight_text.replace('%', '').replace(',', '.'))
+                                        underlying["weight"] = float(weight_text.translate(IT_PERCENT_TABLE))
                                     except:
                                         pass
                             
@@ -247,36 +282,30 @@ def extract_certificate_data(page, isin):
         return cert
         
     except Exception as e:
-        print(f"  ❌ Error extracting {isin}: {e}")
+        logger.warning("  ❌ Error extracting %s: %s", isin, e)
         return None
 
 
-def get_certificate_list(page):
+async def get_certificate_list(page):
     """Ottiene la lista dei certificati dalla pagina principale"""
     print("📋 Fetching certificate list...")
     
     certificates = []
     
     try:
-        page.goto(CONFIG["list_url"], timeout=CONFIG["page_timeout"])
-        page.wait_for_load_state("networkidle")
-        page.wait_for_timeout(2000)
+        await page.goto(CONFIG["list_url"], wait_until="domcontentloaded", timeout=CONFIG["page_timeout"])
         
-        # Estrai tutti gli ISIN dalla pagina
-        html = page.content()
+        # Aspetta il primo link a una scheda invece di un'attesa fissa
+        try:
+            await page.wait_for_selector('a[href*="scheda_certificato"]', timeout=CONFIG["selector_timeout"])
+        except:
+            pass
         
-        # Pattern ISIN standard
-        isin_pattern = re.compile(r'isin=([A-Z]{2}[A-Z0-9]{10})')
-        found_isins = set(isin_pattern.findall(html))
+        # Estrai tutti gli ISIN dalla pagina
+        html = await page.content()
         
-        # Pattern alternativo nelle celle tabella
-        soup = BeautifulSoup(html, 'html.parser')
-        for link in soup.find_all('a', href=True):
-            href = link.get('href', '')
-            if 'scheda_certificato' in href:
-                isin_match = re.search(r'isin=([A-Z]{2}[A-Z0-9]{10})', href)
-                if isin_match:
-                    found_isins.add(isin_match.group(1))
+        # Pattern ISIN nei link "...scheda_certificato.asp?isin=..." (un solo passaggio sull'HTML)
+        found_isins = set(ISIN_HREF_RE.findall(html))
         
         # Filtra per ISIN validi
         for isin in found_isins:
@@ -288,10 +317,60 @@ def get_certificate_list(page):
     except Exception as e:
         print(f"  ❌ Error fetching list: {e}")
     
+    # Aggiungi in coda gli ISIN dei run precedenti non più in lista,
+    # finché non mancano dalla lista da più di isins_max_age (scaduti o delistati)
+    now = time.time()
+    cutoff = now - CONFIG["isins_max_age"]
+    known = {isin: last_seen for isin, last_seen in load_known_isins().items() if last_seen > cutoff}
+    seen = set()
+    for cert in certificates:
+        seen.add(cert["isin"])
+        known[cert["isin"]] = now
+    
+    previous = [isin for isin in known if isin not in seen]
+    if previous:
+        certificates.extend({"isin": isin} for isin in previous)
+        print(f"  ➕ {len(previous)} ISINs from previous runs")
+    save_known_isins(known)
+    
     return certificates
 
 
-def main():
+def load_known_isins():
+    """ISIN -> ultimo timestamp in cui era nella lista"""
+    try:
+        with open(CONFIG["isins_file"], encoding='utf-8') as f:
+            known = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if isinstance(known, list):
+        # Formato precedente senza date: conta come visti ora
+        return dict.fromkeys(known, time.time())
+    return known
+
+
+def save_known_isins(isins):
+    os.makedirs(os.path.dirname(CONFIG["isins_file"]), exist_ok=True)
+    with open(CONFIG["isins_file"], 'w', encoding='utf-8') as f:
+        json.dump(isins, f, indent=2)
+
+
+async def certificate_worker(context, queue, results, total):
+    """Estrae i certificati in coda su una sola pagina, riusata per tutti gli ISIN"""
+    page = await context.new_page()
+    try:
+        while True:
+            try:
+                i, isin = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            logger.debug("[%d/%d] %s", i, total, isin)
+            results[i - 1] = await extract_certificate_data(context, page, isin)
+    finally:
+        await page.close()
+
+
+async def main():
     """Main function"""
     print("=" * 60)
     print("🚀 Certificates Scraper - certificatiederivati.it v12")
@@ -301,16 +380,17 @@ def main():
     all_certificates = []
     filtered_certificates = []
     
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        context = await browser.new_context(
             user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
         )
-        page = context.new_page()
+        await context.route("**/*", block_resources)
+        page = await context.new_page()
         
         try:
             # 1. Ottieni lista certificati
-            cert_list = get_certificate_list(page)
+            cert_list = await get_certificate_list(page)
             
             if not cert_list:
                 print("❌ No certificates found!")
@@ -320,12 +400,17 @@ def main():
             cert_list = cert_list[:CONFIG["max_certificates"]]
             print(f"\n📊 Processing {len(cert_list)} certificates...")
             
-            # 2. Estrai dati dettagliati per ogni certificato
+            # 2. Estrai dati dettagliati per ogni certificato (in parallelo)
+            queue = asyncio.Queue()
             for i, cert in enumerate(cert_list, 1):
-                print(f"\n[{i}/{len(cert_list)}] {cert['isin']}")
-                
-                cert_data = extract_certificate_data(page, cert["isin"])
-                
+                queue.put_nowait((i, cert["isin"]))
+            results = [None] * len(cert_list)
+            await asyncio.gather(*(
+                certificate_worker(context, queue, results, len(cert_list))
+                for _ in range(min(CONFIG["concurrency"], len(cert_list)))
+            ))
+            
+            for cert_data in results:
                 if cert_data:
                     all_certificates.append(cert_data)
                     
@@ -338,15 +423,12 @@ def main():
                     
                     if has_target:
                         filtered_certificates.append(cert_data)
-                        print(f"    ✅ Target underlying found - included")
+                        logger.debug("    ✅ %s: target underlying found - included", cert_data['isin'])
                     else:
-                        print(f"    ⚠️ No target underlying - excluded from filter")
-                
-                # Pausa per non sovraccaricare il server
-                page.wait_for_timeout(500)
+                        logger.debug("    ⚠️ %s: no target underlying - excluded from filter", cert_data['isin'])
             
         finally:
-            browser.close()
+            await browser.close()
     
     # 3. Genera output
     output = {
@@ -361,9 +443,9 @@ def main():
         "certificates": filtered_certificates
     }
     
-    # Salva output
-    with open(CONFIG["output_file"], 'w', encoding='utf-8') as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    # Salva output (serializzato in un'unica stringa e scritto in un colpo solo)
+    with open(CONFIG["output_file"], 'wb') as f:
+        f.write(json.dumps(output, indent=2, ensure_ascii=False).encode('utf-8'))
     
     print("\n" + "=" * 60)
     print("📊 SCRAPING COMPLETED")
@@ -395,4 +477,8 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    logging.basicConfig(
+        level=logging.DEBUG if "-v" in sys.argv[1:] else logging.WARNING,
+        format="%(message)s"
+    )
+    asyncio.run(main())
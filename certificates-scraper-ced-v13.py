@@ -6,12 +6,17 @@ Version 13 - URL corretto per nuove emissioni
 Estrae dati certificati dalla pagina nuove emissioni.
 """
 
-import json
+import asyncio
+import orjson
+import os
 import re
 import sys
+from collections import Counter
 from datetime import datetime
-from playwright.sync_api import sync_playwright
+from playwright.async_api import async_playwright
 from bs4 import BeautifulSoup
+from lxml import html as lxml_html
+from scraper_common import HtmlCache, PageFetcher, RateLimiter, block_resources, cell_text, has_marker
 
 # Configurazione
 CONFIG = {
@@ -20,6 +25,12 @@ CONFIG = {
     "detail_url": "https://www.certificatiederivati.it/db_bs_scheda_certificato.asp?isin=",
     "max_certificates": 150,
     "page_timeout": 30000,
+    "selector_timeout": 10000,
+    "detail_workers": 8,
+    "requests_per_second": 5,  # Limite complessivo verso il sito, condiviso dai worker
+    "cache_dir": "data/cache",  # HTML schede per ISIN, riusato tra run
+    "cache_ttl": 86400,
+    "storage_state": "data/browser-state.json",  # Cookie/storage mantenuti tra run
     "output_file": "certificates-data.json"
 }
 
@@ -47,13 +58,28 @@ TARGET_UNDERLYINGS = [
     "NIKKEI", "HANG SENG", "RUSSELL"
 ]
 
-def is_target_underlying(text):
-    """Verifica se il testo contiene un sottostante target"""
-    if not text:
+# Pattern compilati una volta sola
+ISIN_RE = re.compile(r'^[A-Z]{2}[A-Z0-9]{10}$')
+BARRIER_RE = re.compile(r'barriera:\s*["\'](\d+(?:[.,]\d+)?)\s*(?:&nbsp;)?%["\']')
+LEVEL_RE = re.compile(r'livello:\s*["\'](\d+(?:[.,]\d+)?)["\']')
+TYPE_RE = re.compile(r'tipo:\s*["\'](\w+)["\']')
+REACHED_RE = re.compile(r'raggiunta:\s*["\']?(true|false)["\']?', re.IGNORECASE)
+EMITTENTE_RE = re.compile(r'Scheda Emittente', re.IGNORECASE)
+SOTTOSTANTE_RE = re.compile(r'Scheda Sottostante', re.IGNORECASE)
+# Cella di tabella, in qualsiasi maiuscolo/minuscolo: la lista è arrivata con i dati
+TABLE_CELL_RE = re.compile(r'<td\b', re.IGNORECASE)
+
+# Sezione che compare quando la scheda certificato è completa
+CERTIFICATE_MARKER = "Scheda Sottostante"
+DETAIL_READY = f'h3:has-text("{CERTIFICATE_MARKER}")'
+
+def is_target_underlying(text_upper):
+    """Verifica se il testo, già in maiuscolo, contiene un sottostante target"""
+    if not text_upper:
         return False
-    text_upper = text.upper()
+    # TARGET_UNDERLYINGS è già in maiuscolo
     for target in TARGET_UNDERLYINGS:
-        if target.upper() in text_upper:
+        if target in text_upper:
             return True
     return False
 
@@ -68,39 +94,45 @@ def extract_barrier_from_js(html_content):
     }
     
     # Pattern per barriera: "50&nbsp;%" o "50 %"
-    barrier_match = re.search(r'barriera:\s*["\'](\d+(?:[.,]\d+)?)\s*(?:&nbsp;)?%["\']', html_content)
+    barrier_match = BARRIER_RE.search(html_content)
     if barrier_match:
         barrier_data["percentage"] = float(barrier_match.group(1).replace(',', '.'))
     
     # Pattern per livello: "665,855" o "665.855"
-    level_match = re.search(r'livello:\s*["\'](\d+(?:[.,]\d+)?)["\']', html_content)
+    level_match = LEVEL_RE.search(html_content)
     if level_match:
         barrier_data["level"] = float(level_match.group(1).replace(',', '.'))
     
     # Pattern per tipo: "DISCRETA" o "CONTINUA"
-    type_match = re.search(r'tipo:\s*["\'](\w+)["\']', html_content)
+    type_match = TYPE_RE.search(html_content)
     if type_match:
         barrier_data["type"] = type_match.group(1)
     
     # Pattern per raggiunta: "true" o "false"
-    reached_match = re.search(r'raggiunta:\s*["\']?(true|false)["\']?', html_content, re.IGNORECASE)
+    reached_match = REACHED_RE.search(html_content)
     if reached_match:
         barrier_data["reached"] = reached_match.group(1).lower() == "true"
     
     return barrier_data
 
 
-def extract_certificate_data(page, isin, list_data=None):
+detail_fetcher = PageFetcher(
+    has_marker(CERTIFICATE_MARKER),
+    DETAIL_READY,
+    CONFIG["page_timeout"],
+    CONFIG["selector_timeout"],
+    rate_limiter=RateLimiter(CONFIG["requests_per_second"]),
+    cache=HtmlCache(CONFIG["cache_dir"], CONFIG["cache_ttl"])
+)
+# La tabella della lista è generata lato server: basta una GET, il browser solo come ripiego
+list_fetcher = PageFetcher(TABLE_CELL_RE.search, 'table tr td', CONFIG["page_timeout"], CONFIG["selector_timeout"])
+
+
+async def extract_certificate_data(context, page, isin, list_data=None, scraped_at=None):
     """Estrae tutti i dati da una pagina certificato"""
-    url = f"{CONFIG['detail_url']}{isin}"
-    
     try:
-        page.goto(url, timeout=CONFIG["page_timeout"])
-        page.wait_for_load_state("networkidle")
-        page.wait_for_timeout(1500)
-        
-        html = page.content()
-        soup = BeautifulSoup(html, 'html.parser')
+        html = await detail_fetcher.fetch(context, page, f"{CONFIG['detail_url']}{isin}", isin)
+        soup = BeautifulSoup(html, 'lxml')
         
         cert = {
             "isin": isin,
@@ -118,7 +150,7 @@ def extract_certificate_data(page, isin, list_data=None):
             "nominal": 1000,
             "underlyings": [],
             "source": "certificatiederivati.it",
-            "scraped_at": datetime.now().isoformat()
+            "scraped_at": scraped_at or datetime.now().isoformat()
         }
         
         # 1. TIPO CERTIFICATO - dall'header del panel principale
@@ -156,7 +188,7 @@ def extract_certificate_data(page, isin, list_data=None):
                             pass
         
         # 3. EMITTENTE - dalla sezione "Scheda Emittente"
-        emittente_panel = soup.find('h3', string=re.compile(r'Scheda Emittente', re.IGNORECASE))
+        emittente_panel = soup.find('h3', string=EMITTENTE_RE)
         if emittente_panel:
             parent_panel = emittente_panel.find_parent('div', class_='panel')
             if parent_panel:
@@ -171,7 +203,7 @@ def extract_certificate_data(page, isin, list_data=None):
                                 break
         
         # 4. SOTTOSTANTI - dalla sezione "Scheda Sottostante"
-        sottostante_panel = soup.find('h3', string=re.compile(r'Scheda Sottostante', re.IGNORECASE))
+        sottostante_panel = soup.find('h3', string=SOTTOSTANTE_RE)
         if sottostante_panel:
             header_text = sottostante_panel.get_text(strip=True)
             if "Basket" in header_text:
@@ -231,41 +263,45 @@ def extract_certificate_data(page, isin, list_data=None):
         return None
 
 
-def get_certificate_list(page):
+async def get_certificate_list(context):
     """Ottiene la lista dei certificati dalla pagina nuove emissioni"""
     print("📋 Fetching certificate list from nuove emissioni...")
     
     certificates = []
     
     try:
-        page.goto(CONFIG["list_url"], timeout=CONFIG["page_timeout"])
-        page.wait_for_load_state("networkidle")
-        page.wait_for_timeout(2000)
+        html = await list_fetcher.get(context, CONFIG["list_url"])
+        if html is None:
+            page = await context.new_page()
+            try:
+                html = await list_fetcher.render(page, CONFIG["list_url"])
+            finally:
+                await page.close()
         
-        html = page.content()
-        soup = BeautifulSoup(html, 'html.parser')
+        tree = lxml_html.fromstring(html)
         
         # Trova tutte le tabelle
-        tables = soup.find_all('table')
+        tables = list(tree.iter('table'))
         print(f"  📊 Found {len(tables)} tables")
         
         for table in tables:
-            rows = table.find_all('tr')
-            for row in rows:
-                cells = row.find_all('td')
+            for row in table.iter('tr'):
+                cells = list(row.iter('td'))
                 if len(cells) >= 5:
                     # Prima cella dovrebbe essere ISIN
-                    isin_text = cells[0].get_text(strip=True)
+                    isin_text = cell_text(cells[0])
                     
                     # Verifica che sia un ISIN valido
-                    if len(isin_text) == 12 and re.match(r'^[A-Z]{2}[A-Z0-9]{10}$', isin_text):
+                    if len(isin_text) == 12 and ISIN_RE.match(isin_text):
+                        # Solo le colonne usate, ognuna letta una volta
+                        texts = [cell_text(td) for td in cells[1:6]]
                         cert_data = {
                             "isin": isin_text,
-                            "name": cells[1].get_text(strip=True) if len(cells) > 1 else "",
-                            "issuer": cells[2].get_text(strip=True) if len(cells) > 2 else "",
-                            "underlying_type": cells[3].get_text(strip=True) if len(cells) > 3 else "",
-                            "market": cells[4].get_text(strip=True) if len(cells) > 4 else "",
-                            "date": cells[5].get_text(strip=True) if len(cells) > 5 else ""
+                            "name": texts[0],
+                            "issuer": texts[1],
+                            "underlying_type": texts[2],
+                            "market": texts[3],
+                            "date": texts[4] if len(texts) > 4 else ""
                         }
                         certificates.append(cert_data)
         
@@ -277,26 +313,71 @@ def get_certificate_list(page):
     return certificates
 
 
-def main():
+async def fetch_details(context, queue, results, total, scraped_at):
+    """Worker: estrae i dettagli dei certificati in coda riusando una sola pagina"""
+    page = await context.new_page()
+    try:
+        while True:
+            try:
+                i, cert = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            
+            print(f"\n[{i + 1}/{total}] {cert['isin']} - {cert['name'][:40]}...")
+            
+            cert_data = await extract_certificate_data(context, page, cert["isin"], cert, scraped_at)
+            
+            if cert_data:
+                results[i] = cert_data
+                
+                # Verifica finale se ha sottostanti target
+                has_target = False
+                
+                # Check underlying_type dalla lista
+                if is_target_underlying(cert.get("underlying_type", "").upper()):
+                    has_target = True
+                
+                # Check i singoli sottostanti estratti
+                for underlying in cert_data.get("underlyings", []):
+                    if is_target_underlying(underlying.get("name", "").upper()):
+                        has_target = True
+                        break
+                
+                if has_target:
+                    print(f"    ✅ Included")
+                else:
+                    # Includi comunque se era pre-filtrato
+                    print(f"    ✅ Included (pre-filtered)")
+    finally:
+        await page.close()
+
+
+async def main():
     """Main function"""
+    started = datetime.now()
+    scraped_at = started.isoformat()  # Un solo timestamp per tutto il run
+    
     print("=" * 60)
     print("🚀 Certificates Scraper - certificatiederivati.it v13")
-    print(f"📅 {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print(f"📅 {started.strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 60)
     
     all_certificates = []
     filtered_certificates = []
     
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        # Riparti da cookie e local storage del run precedente, se presenti
+        state = CONFIG["storage_state"] if os.path.exists(CONFIG["storage_state"]) else None
+        context = await browser.new_context(
+            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+            storage_state=state
         )
-        page = context.new_page()
+        await context.route('**/*', block_resources)
         
         try:
             # 1. Ottieni lista certificati dalla pagina nuove emissioni
-            cert_list = get_certificate_list(page)
+            cert_list = await get_certificate_list(context)
             
             if not cert_list:
                 print("❌ No certificates found in list!")
@@ -306,8 +387,9 @@ def main():
             target_certs = []
             for cert in cert_list:
                 underlying_type = cert.get("underlying_type", "")
+                underlying_upper = underlying_type.upper()
                 # Includi "Basket di indici" ma escludi "Basket di azioni" e "Singolo Sottostante"
-                if is_target_underlying(underlying_type) or "indici" in underlying_type.lower():
+                if is_target_underlying(underlying_upper) or "INDICI" in underlying_upper:
                     target_certs.append(cert)
                     print(f"  🎯 Target: {cert['isin']} - {cert['name']} ({underlying_type})")
             
@@ -324,47 +406,34 @@ def main():
             
             print(f"\n📊 Processing {len(target_certs)} certificates...")
             
-            # 2. Estrai dati dettagliati per ogni certificato
-            for i, cert in enumerate(target_certs, 1):
-                print(f"\n[{i}/{len(target_certs)}] {cert['isin']} - {cert['name'][:40]}...")
-                
-                cert_data = extract_certificate_data(page, cert["isin"], cert)
-                
-                if cert_data:
-                    all_certificates.append(cert_data)
-                    
-                    # Verifica finale se ha sottostanti target
-                    has_target = False
-                    
-                    # Check underlying_type dalla lista
-                    if is_target_underlying(cert.get("underlying_type", "")):
-                        has_target = True
-                    
-                    # Check i singoli sottostanti estratti
-                    for underlying in cert_data.get("underlyings", []):
-                        if is_target_underlying(underlying.get("name", "")):
-                            has_target = True
-                            break
-                    
-                    if has_target:
-                        filtered_certificates.append(cert_data)
-                        print(f"    ✅ Included")
-                    else:
-                        # Includi comunque se era pre-filtrato
-                        filtered_certificates.append(cert_data)
-                        print(f"    ✅ Included (pre-filtered)")
-                
-                # Pausa per non sovraccaricare il server
-                page.wait_for_timeout(500)
+            # 2. Estrai dati dettagliati, più pagine in parallelo
+            queue = asyncio.Queue()
+            for item in enumerate(target_certs):
+                queue.put_nowait(item)
+            
+            results = [None] * len(target_certs)
+            await asyncio.gather(*(
+                fetch_details(context, queue, results, len(target_certs), scraped_at)
+                for _ in range(min(CONFIG["detail_workers"], len(target_certs)))
+            ))
+            
+            # Tutti i certificati estratti erano pre-filtrati: restano inclusi
+            all_certificates = [cert_data for cert_data in results if cert_data]
+            filtered_certificates = list(all_certificates)
             
         finally:
-            browser.close()
+            try:
+                os.makedirs(os.path.dirname(CONFIG["storage_state"]), exist_ok=True)
+                await context.storage_state(path=CONFIG["storage_state"])
+            except Exception as e:
+                print(f"  ⚠️ Could not save browser state: {str(e)[:40]}")
+            await browser.close()
     
     # 3. Genera output
     output = {
         "metadata": {
             "scraper_version": "13.0",
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": scraped_at,
             "source": "certificatiederivati.it",
             "source_page": "db_bs_nuove_emissioni.asp",
             "total_scraped": len(all_certificates),
@@ -375,8 +444,8 @@ def main():
     }
     
     # Salva output
-    with open(CONFIG["output_file"], 'w', encoding='utf-8') as f:
-        json.dump(output, f, indent=2, ensure_ascii=False)
+    with open(CONFIG["output_file"], 'wb') as f:
+        f.write(orjson.dumps(output, option=orjson.OPT_INDENT_2))
     
     print("\n" + "=" * 60)
     print("📊 SCRAPING COMPLETED")
@@ -386,28 +455,21 @@ def main():
     print("=" * 60)
     
     # Statistiche per tipo
-    type_stats = {}
-    for cert in filtered_certificates:
-        t = cert.get("type", "Unknown")
-        type_stats[t] = type_stats.get(t, 0) + 1
+    type_stats = Counter(cert.get("type", "Unknown") for cert in filtered_certificates)
     
     if type_stats:
         print("\n📈 Distribution by type:")
-        for t, count in sorted(type_stats.items(), key=lambda x: -x[1])[:10]:
+        for t, count in type_stats.most_common(10):
             print(f"  - {t}: {count}")
     
     # Statistiche per emittente
-    issuer_stats = {}
-    for cert in filtered_certificates:
-        i = cert.get("issuer", "Unknown")
-        if i:
-            issuer_stats[i] = issuer_stats.get(i, 0) + 1
+    issuer_stats = Counter(i for i in (cert.get("issuer", "Unknown") for cert in filtered_certificates) if i)
     
     if issuer_stats:
         print("\n🏛️ Distribution by issuer:")
-        for i, count in sorted(issuer_stats.items(), key=lambda x: -x[1])[:10]:
+        for i, count in issuer_stats.most_common(10):
             print(f"  - {i}: {count}")
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
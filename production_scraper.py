@@ -16,12 +16,16 @@ Sections on detail page:
 Usage: python production_scraper.py
 """
 
-import json
+import asyncio
+import orjson
 import re
 import os
+from collections import Counter
 from datetime import datetime, timedelta
-from playwright.sync_api import sync_playwright
+from functools import lru_cache
+from playwright.async_api import async_playwright
 from bs4 import BeautifulSoup
+from scraper_common import PageFetcher, RateLimiter, has_marker
 import time
 
 # ===================================
@@ -35,8 +39,11 @@ CONFIG = {
     'max_pages': 50,
     'max_certificates': 150,
     'timeout': 30000,
-    'wait_between_pages': 1500,
-    'wait_between_details': 1200,
+    'selector_timeout': 5000,
+    'requests_per_second': 5,
+    'detail_workers': 8,
+    'detail_cache_path': 'data/detail_cache.json',
+    'detail_cache_ttl': 86400,
     'output_path': 'data/certificates-data.json'
 }
 
@@ -115,10 +122,12 @@ ISSUER_MAP = {
     'santander': 'Santander'
 }
 
-# Certificate type detection
-TYPE_PATTERNS = [
+# Certificate type detection, first match wins: a pattern must come
+# before any shorter pattern it contains
+TYPE_PATTERNS = (
     ('phoenix memory', 'Phoenix Memory'),
     ('cash collect memory', 'Cash Collect Memory'),
+    ('fixed cash collect', 'Fixed Cash Collect'),
     ('cash collect', 'Cash Collect'),
     ('bonus cap', 'Bonus Cap'),
     ('top bonus', 'Top Bonus'),
@@ -131,18 +140,39 @@ TYPE_PATTERNS = [
     ('memory', 'Memory'),
     ('phoenix', 'Phoenix'),
     ('reverse', 'Reverse'),
-    ('fixed cash collect', 'Fixed Cash Collect'),
     ('fixed', 'Fixed Coupon'),
     ('benchmark', 'Benchmark'),
     ('tracker', 'Tracker'),
     ('outperformance', 'Outperformance'),
     ('twin win', 'Twin Win'),
+    ('softcallable', 'Softcallable'),
     ('callable', 'Callable'),
     ('maxi', 'Maxi Cash Collect'),
-    ('softcallable', 'Softcallable'),
     ('athena', 'Athena'),
     ('coupon', 'Coupon'),
-]
+)
+
+# Present only when the detail page came back complete from a plain GET
+DETAIL_MARKERS = ('titoloprodotto', 'Scheda Sottostante')
+
+# Precompiled patterns
+ISIN_RE = re.compile(r'^[A-Z]{2}[A-Z0-9]{10}$')
+DATE_DMY_RE = re.compile(r'^(\d{1,2})/(\d{1,2})/(\d{4})$')
+DATE_ISO_RE = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+BARRIER_VALUE_RE = re.compile(r'^\d{1,2}[\.,]?\d*$')
+
+SCENARIO_VARIATIONS = (-50, -40, -30, -20, -10, 0, 10, 20, 30, 40, 50)
+
+
+rate_limiter = RateLimiter(CONFIG['requests_per_second'])
+# Detail pages: plain GET, rendered in the browser (waiting for the product header) only if incomplete
+detail_fetcher = PageFetcher(
+    has_marker(*DETAIL_MARKERS),
+    '.titoloprodotto',
+    CONFIG['timeout'],
+    CONFIG['selector_timeout'],
+    rate_limiter=rate_limiter
+)
 
 
 def log(msg, level='INFO'):
@@ -151,10 +181,8 @@ def log(msg, level='INFO'):
     print(f"[{timestamp}] [{level}] {msg}")
 
 
-def categorize_underlying(text):
-    """Categorize underlying based on keywords"""
-    text_lower = text.lower()
-    
+def categorize_underlying(text_lower):
+    """Categorize underlying based on keywords (expects lowercased text)"""
     for category, keywords in CATEGORY_KEYWORDS.items():
         for kw in keywords:
             if kw in text_lower:
@@ -163,9 +191,8 @@ def categorize_underlying(text):
     return 'stock'
 
 
-def is_leverage_product(name):
-    """Check if certificate is a leverage product"""
-    name_lower = name.lower()
+def is_leverage_product(name_lower):
+    """Check if certificate is a leverage product (expects lowercased name)"""
     return any(kw in name_lower for kw in LEVERAGE_KEYWORDS)
 
 
@@ -206,13 +233,13 @@ def parse_date(date_str):
         return None
     
     # Try dd/mm/yyyy format
-    match = re.match(r'^(\d{1,2})/(\d{1,2})/(\d{4})$', date_str)
+    match = DATE_DMY_RE.match(date_str)
     if match:
         d, m, y = match.groups()
         return f"{y}-{m.zfill(2)}-{d.zfill(2)}"
     
     # Try yyyy-mm-dd format
-    match = re.match(r'^(\d{4})-(\d{2})-(\d{2})$', date_str)
+    match = DATE_ISO_RE.match(date_str)
     if match:
         return date_str
     
@@ -234,7 +261,7 @@ def parse_number(text):
     
     try:
         return float(text)
-    except:
+    except ValueError:
         return None
 
 
@@ -243,33 +270,23 @@ def parse_percentage(text):
     if not text:
         return None
     
-    text = str(text).strip().replace('%', '').replace(' ', '')
-    text = text.replace(',', '.')
+    text = str(text).strip().replace('%', '').replace(' ', '').replace(',', '.')
     
     try:
-        val = float(text)
-        return val
-    except:
+        return float(text)
+    except ValueError:
         return None
 
 
-def generate_scenario_analysis(barrier, purchase_price=100):
-    """Generate scenario analysis for a certificate"""
-    if not barrier:
-        barrier = 60
-    
+@lru_cache(maxsize=None)
+def _scenario_rows(barrier, purchase_price):
+    """Scenario rows for one (barrier, purchase_price) pair, shared between certificates"""
     scenarios = []
-    variations = [-50, -40, -30, -20, -10, 0, 10, 20, 30, 40, 50]
     
-    for var in variations:
+    for var in SCENARIO_VARIATIONS:
         underlying_level = 100 + var
-        
-        if underlying_level < barrier:
-            redemption = underlying_level
-            pl = redemption - purchase_price
-        else:
-            redemption = 100
-            pl = redemption - purchase_price
+        redemption = underlying_level if underlying_level < barrier else 100
+        pl = redemption - purchase_price
         
         scenarios.append({
             'variation_pct': var,
@@ -279,18 +296,23 @@ def generate_scenario_analysis(barrier, purchase_price=100):
             'pl_pct': round((pl / purchase_price) * 100, 2) if purchase_price else 0
         })
     
+    return scenarios
+
+
+def generate_scenario_analysis(barrier, purchase_price=100):
+    """Generate scenario analysis for a certificate"""
+    if not barrier:
+        barrier = 60
+    
     return {
-        'scenarios': scenarios,
+        'scenarios': _scenario_rows(barrier, purchase_price),
         'purchase_price': purchase_price
     }
 
 
-def extract_detail_data(page, isin):
-    """
-    Extract detailed data from certificate detail page
-    Based on actual page structure from certificatiederivati.it
-    """
-    data = {
+def empty_detail_data():
+    """Detail fields with their defaults"""
+    return {
         'type': None,
         'market': None,
         'issue_date': None,
@@ -309,14 +331,17 @@ def extract_detail_data(page, isin):
         'autocallable': False,
         'memory_effect': False
     }
+
+
+def parse_detail_html(html, isin):
+    """
+    Extract detailed data from certificate detail page HTML
+    Based on actual page structure from certificatiederivati.it
+    """
+    data = empty_detail_data()
     
     try:
-        url = f"{CONFIG['detail_url']}{isin}"
-        page.goto(url, timeout=CONFIG['timeout'])
-        page.wait_for_timeout(1500)
-        
-        html = page.content()
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = BeautifulSoup(html, 'lxml')
         
         # ===== HEADER SECTION =====
         header = soup.find('td', class_='titoloprodotto') or soup.find('th', class_='titoloprodotto')
@@ -324,15 +349,20 @@ def extract_detail_data(page, isin):
             data['type'] = header.get_text(strip=True)
         
         # ===== FIND ALL TABLES =====
-        all_tables = soup.find_all('table')
-        
-        for table in all_tables:
-            rows = table.find_all('tr')
-            for row in rows:
-                cells = row.find_all('td')
+        # Walked once: (table, upper-case text, [(row, cell texts)]) reused by every section
+        all_tables = []
+        for table in soup.find_all('table'):
+            rows = [
+                (row, [cell.get_text(strip=True) for cell in row.find_all('td')])
+                for row in table.find_all('tr')
+            ]
+            all_tables.append((table, table.get_text(strip=True).upper(), rows))
+        
+        for _, _, rows in all_tables:
+            for row, cells in rows:
                 if len(cells) >= 2:
-                    label = cells[0].get_text(strip=True).upper()
-                    value = cells[1].get_text(strip=True)
+                    label = cells[0].upper()
+                    value = cells[1]
                     
                     # Market
                     if 'MERCATO' in label:
@@ -365,16 +395,12 @@ def extract_detail_data(page, isin):
                             data['trigger_autocall'] = num
         
         # ===== SCHEDA SOTTOSTANTE =====
-        for table in all_tables:
-            table_text = table.get_text(strip=True).upper()
-            
+        for _, table_text, rows in all_tables:
             if 'SOTTOSTANTE' in table_text and ('DESCRIZIONE' in table_text or 'STRIKE' in table_text):
-                rows = table.find_all('tr')
-                for row in rows:
-                    cells = row.find_all('td')
+                for _, cells in rows:
                     if len(cells) >= 2:
-                        name = cells[0].get_text(strip=True)
-                        strike_text = cells[1].get_text(strip=True) if len(cells) > 1 else ''
+                        name = cells[0]
+                        strike_text = cells[1]
                         strike = parse_number(strike_text)
                         
                         # Skip headers and empty rows
@@ -387,25 +413,20 @@ def extract_detail_data(page, isin):
                             data['underlyings'].append(underlying)
         
         # ===== BARRIERA DOWN =====
-        for table in all_tables:
-            table_text = table.get_text(strip=True).upper()
-            
+        for _, table_text, rows in all_tables:
             if 'BARRIERA' in table_text:
-                rows = table.find_all('tr')
-                for row in rows:
-                    cells = row.find_all('td')
+                for row, cells in rows:
                     row_text = row.get_text(strip=True)
                     
                     # Look for percentage in cells
-                    for cell in cells:
-                        cell_text = cell.get_text(strip=True)
+                    for cell_text in cells:
                         if '%' in cell_text:
                             barrier_val = parse_percentage(cell_text)
                             if barrier_val and 10 <= barrier_val <= 100:
                                 data['barrier'] = barrier_val
                                 break
                         # Also try without % symbol
-                        elif re.match(r'^\d{1,2}[\.,]?\d*$', cell_text):
+                        elif BARRIER_VALUE_RE.match(cell_text):
                             barrier_val = parse_percentage(cell_text)
                             if barrier_val and 10 <= barrier_val <= 100:
                                 data['barrier'] = barrier_val
@@ -420,20 +441,18 @@ def extract_detail_data(page, isin):
                         data['barrier_type'] = 'Europea'
         
         # ===== DATE RILEVAMENTO (Coupon) =====
-        for table in all_tables:
+        for table, _, rows in all_tables:
             # Find table with CEDOLA header
             headers = [th.get_text(strip=True).upper() for th in table.find_all('th')]
             
             if 'CEDOLA' in headers or 'TRIGGER CEDOLA' in headers:
-                rows = table.find_all('tr')[1:]  # Skip header row
+                rows = rows[1:]  # Skip header row
                 
                 if rows:
                     # Get first data row
-                    first_row = rows[0]
-                    cells = first_row.find_all('td')
+                    _, cells = rows[0]
                     
-                    for i, cell in enumerate(cells):
-                        cell_text = cell.get_text(strip=True)
+                    for cell_text in cells:
                         pct = parse_percentage(cell_text)
                         
                         if pct is not None:
@@ -445,13 +464,9 @@ def extract_detail_data(page, isin):
                                 data['trigger_coupon'] = pct
         
         # ===== SCHEDA EMITTENTE =====
-        for table in all_tables:
-            table_text = table.get_text(strip=True).upper()
-            
+        for _, table_text, rows in all_tables:
             if 'EMITTENTE' in table_text:
-                cells = table.find_all('td')
-                for cell in cells:
-                    cell_text = cell.get_text(strip=True)
+                for cell_text in (text for _, cells in rows for text in cells):
                     for key, name in ISSUER_MAP.items():
                         if key in cell_text.lower():
                             data['issuer'] = name
@@ -472,7 +487,79 @@ def extract_detail_data(page, isin):
     return data
 
 
-def scrape_certificates():
+async def extract_detail_data(context, page, isin):
+    """Fetch and parse a certificate detail page; None if the fetch failed"""
+    try:
+        html = await detail_fetcher.fetch(context, page, f"{CONFIG['detail_url']}{isin}")
+    except Exception as e:
+        log(f"Error extracting {isin}: {str(e)[:60]}", 'WARN')
+        return None
+    
+    return parse_detail_html(html, isin)
+
+
+def load_detail_cache():
+    """Load cached detail data, dropping entries older than the TTL"""
+    try:
+        with open(CONFIG['detail_cache_path'], 'rb') as f:
+            cache = orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return {}
+    
+    cutoff = time.time() - CONFIG['detail_cache_ttl']
+    return {isin: entry for isin, entry in cache.items() if entry.get('fetched_at', 0) > cutoff}
+
+
+def save_detail_cache(cache):
+    """Persist detail data for the next run"""
+    os.makedirs(os.path.dirname(CONFIG['detail_cache_path']), exist_ok=True)
+    with open(CONFIG['detail_cache_path'], 'wb') as f:
+        f.write(orjson.dumps(cache))
+
+
+async def fetch_details(context, queue, stats, total, cache):
+    """Phase 2 worker: fetch details for queued certificates, reusing one page"""
+    page = await context.new_page()
+    try:
+        while True:
+            try:
+                cert = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            
+            try:
+                cached = cache.get(cert['isin'])
+                if cached:
+                    details = cached['data']
+                    stats['details_cached'] += 1
+                else:
+                    details = await extract_detail_data(context, page, cert['isin'])
+                    if details is None:
+                        # Failed fetch: use the defaults for this run, retry on the next
+                        details = empty_detail_data()
+                    elif details != empty_detail_data():
+                        # Only cache pages that yielded at least one detail
+                        cache[cert['isin']] = {'fetched_at': time.time(), 'data': details}
+                
+                cert['details'] = details
+                stats['details_fetched'] += 1
+                
+                if details.get('barrier'):
+                    stats['details_with_barrier'] += 1
+                if details.get('coupon'):
+                    stats['details_with_coupon'] += 1
+                
+                if stats['details_fetched'] % 20 == 0:
+                    log(f"   Progress: {stats['details_fetched']}/{total} (barrier: {stats['details_with_barrier']}, coupon: {stats['details_with_coupon']})")
+                
+            except Exception as e:
+                cert['details'] = {}
+                log(f"   Failed {cert['isin']}: {str(e)[:30]}", 'WARN')
+    finally:
+        await page.close()
+
+
+async def scrape_certificates():
     """Main scraper function"""
     log("=" * 70)
     log("PRODUCTION CERTIFICATES SCRAPER v11.0")
@@ -491,15 +578,16 @@ def scrape_certificates():
         'skipped_stocks': 0,
         'details_fetched': 0,
         'details_with_barrier': 0,
-        'details_with_coupon': 0
+        'details_with_coupon': 0,
+        'details_cached': 0
     }
     
-    with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
-        context = browser.new_context(
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True)
+        context = await browser.new_context(
             user_agent='Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
         )
-        page = context.new_page()
+        page = await context.new_page()
         
         log("✅ Browser launched")
         
@@ -509,18 +597,21 @@ def scrape_certificates():
         for page_num in range(1, CONFIG['max_pages'] + 1):
             try:
                 url = f"{CONFIG['search_url']}?p={page_num}&db=2&fase=quotazione&FiltroDal=2020-1-1&FiltroAl=2099-12-31"
-                page.goto(url, timeout=CONFIG['timeout'])
-                page.wait_for_timeout(CONFIG['wait_between_pages'])
+                await rate_limiter.wait()
+                await page.goto(url, timeout=CONFIG['timeout'], wait_until='domcontentloaded')
+                # Wait for the result rows instead of a fixed delay
+                try:
+                    await page.wait_for_selector('table tr', timeout=CONFIG['selector_timeout'])
+                except:
+                    pass
                 
-                html = page.content()
-                soup = BeautifulSoup(html, 'html.parser')
+                html = await page.content()
+                soup = BeautifulSoup(html, 'lxml')
                 
-                tables = soup.find_all('table')
                 rows_found = 0
                 
-                for table in tables:
-                    rows = table.find_all('tr')
-                    for row in rows[1:]:
+                for table in soup.find_all('table'):
+                    for row in table.find_all('tr')[1:]:
                         cells = row.find_all('td')
                         if len(cells) >= 7:
                             isin = cells[0].get_text(strip=True)
@@ -532,18 +623,19 @@ def scrape_certificates():
                             stats['total_rows'] += 1
                             rows_found += 1
                             
-                            if not re.match(r'^[A-Z]{2}[A-Z0-9]{10}$', isin):
+                            if not ISIN_RE.match(isin):
                                 continue
                             
                             if isin in seen_isins:
                                 continue
                             seen_isins.add(isin)
                             
-                            if is_leverage_product(name):
+                            name_lower = name.lower()
+                            if is_leverage_product(name_lower):
                                 stats['skipped_leverage'] += 1
                                 continue
                             
-                            category = categorize_underlying(f"{sottostante} {name}")
+                            category = categorize_underlying(f"{sottostante.lower()} {name_lower}")
                             
                             if category == 'stock':
                                 stats['skipped_stocks'] += 1
@@ -579,34 +671,25 @@ def scrape_certificates():
         log(f"   ✅ Scanned {stats['pages_scanned']} pages")
         log(f"   ✅ Found {len(certificates)} matching certificates")
         
-        # Phase 2: Fetch details
+        # Phase 2: Fetch details (concurrent workers, one page each)
         log(f"\n📋 PHASE 2: Fetching details for {len(certificates)} certificates...")
         
-        for i, cert in enumerate(certificates):
-            try:
-                details = extract_detail_data(page, cert['isin'])
-                cert['details'] = details
-                stats['details_fetched'] += 1
-                
-                if details.get('barrier'):
-                    stats['details_with_barrier'] += 1
-                if details.get('coupon'):
-                    stats['details_with_coupon'] += 1
-                
-                if (i + 1) % 20 == 0:
-                    log(f"   Progress: {i + 1}/{len(certificates)} (barrier: {stats['details_with_barrier']}, coupon: {stats['details_with_coupon']})")
-                
-                page.wait_for_timeout(CONFIG['wait_between_details'])
-                
-            except Exception as e:
-                cert['details'] = {}
-                log(f"   Failed {cert['isin']}: {str(e)[:30]}", 'WARN')
+        detail_cache = load_detail_cache()
+        queue = asyncio.Queue()
+        for cert in certificates:
+            queue.put_nowait(cert)
+        
+        await asyncio.gather(*(
+            fetch_details(context, queue, stats, len(certificates), detail_cache)
+            for _ in range(min(CONFIG['detail_workers'], len(certificates)))
+        ))
+        save_detail_cache(detail_cache)
         
-        log(f"   ✅ Details fetched: {stats['details_fetched']}")
+        log(f"   ✅ Details fetched: {stats['details_fetched']} ({stats['details_cached']} from cache)")
         log(f"   ✅ With barrier: {stats['details_with_barrier']}")
         log(f"   ✅ With coupon: {stats['details_with_coupon']}")
         
-        browser.close()
+        await browser.close()
         log("\n🔒 Browser closed")
     
     # Phase 3: Build output
@@ -715,33 +798,30 @@ def scrape_certificates():
     log(f"With real barrier: {stats['details_with_barrier']}")
     log(f"With real coupon: {stats['details_with_coupon']}")
     
-    # By category
-    by_category = {}
+    # Aggregates, one pass over the output
+    by_category = Counter()
+    by_issuer = Counter()
+    with_barrier = with_coupon = with_scenario = 0
     for c in output:
-        cat = c['underlying_category']
-        by_category[cat] = by_category.get(cat, 0) + 1
+        by_category[c['underlying_category']] += 1
+        by_issuer[c['issuer']] += 1
+        if c['barrier']:
+            with_barrier += 1
+        if c['annual_coupon_yield']:
+            with_coupon += 1
+        if c['scenario_analysis']:
+            with_scenario += 1
     
     log("\nBy category:")
     icons = {'index': '📊', 'commodity': '🛢️', 'currency': '💱', 'rate': '💹', 'credit_linked': '🏦'}
-    for cat, count in sorted(by_category.items(), key=lambda x: -x[1]):
+    for cat, count in by_category.most_common():
         icon = icons.get(cat, '📄')
         log(f"   {icon} {cat}: {count}")
     
-    # By issuer
-    by_issuer = {}
-    for c in output:
-        iss = c['issuer']
-        by_issuer[iss] = by_issuer.get(iss, 0) + 1
-    
     log("\nTop issuers:")
-    for iss, count in sorted(by_issuer.items(), key=lambda x: -x[1])[:10]:
+    for iss, count in by_issuer.most_common(10):
         log(f"   {iss}: {count}")
     
-    # Data quality
-    with_barrier = sum(1 for c in output if c['barrier'])
-    with_coupon = sum(1 for c in output if c['annual_coupon_yield'])
-    with_scenario = sum(1 for c in output if c['scenario_analysis'])
-    
     log(f"\nData quality:")
     log(f"   With barrier: {with_barrier}/{len(output)} ({100*with_barrier//len(output) if output else 0}%)")
     log(f"   With yield: {with_coupon}/{len(output)} ({100*with_coupon//len(output) if output else 0}%)")
@@ -771,8 +851,8 @@ def scrape_certificates():
         'certificates': output
     }
     
-    with open(CONFIG['output_path'], 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+    with open(CONFIG['output_path'], 'wb') as f:
+        f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
     
     log(f"\n💾 Saved {len(output)} certificates to {CONFIG['output_path']}")
     
@@ -781,7 +861,7 @@ def scrape_certificates():
 
 if __name__ == '__main__':
     try:
-        scrape_certificates()
+        asyncio.run(scrape_certificates())
     except Exception as e:
         log(f"❌ Scraper failed: {e}", 'ERROR')
         import traceback
@@ -14,6 +14,7 @@ import os
 from datetime import datetime, timedelta
 from bs4 import BeautifulSoup
 from playwright.async_api import async_playwright
+from scraper_common import PageFetcher, has_marker
 
 TARGET_UNDERLYINGS = [
     ("FTSEMIB Index", "FTSE MIB"),
@@ -32,6 +33,10 @@ TARGET_UNDERLYINGS = [
     ("EUR001M Index", "Euribor 1M"),
 ]
 
+CONCURRENCY = 5  # Pagine del browser usate in parallelo
+CERTIFICATE_MARKER = "Scheda Sottostante"  # Presente quando la scheda è completa
+detail_fetcher = PageFetcher(has_marker(CERTIFICATE_MARKER), timeout=45000)
+
 
 class CEDScraperV11:
     def __init__(self):
@@ -101,6 +106,7 @@ class CEDScraperV11:
             return None
 
     async def search_underlying(self, page, value, label):
+        """Certificati (isin, nome) trovati per un sottostante, nell'ordine della pagina"""
         self.log(f"Ricerca: {label}")
         try:
             await page.goto('https://www.certificatiederivati.it/db_bs_ricerca_avanzata.asp', 
@@ -114,41 +120,77 @@ class CEDScraperV11:
             
             html = await page.content()
             soup = BeautifulSoup(html, 'html.parser')
-            found = 0
+            matches = []
             
             for link in soup.find_all('a', href=True):
                 href = link.get('href', '')
                 if 'scheda' in href.lower() and 'isin=' in href.lower():
                     match = re.search(r'isin=([A-Z0-9]{12})', href, re.I)
                     if match:
-                        isin = match.group(1).upper()
-                        if isin not in self.certificates:
-                            name = link.get_text(strip=True)
-                            if 'TURBO' in name.upper() or 'LEVA' in name.upper():
-                                continue
-                            self.certificates[isin] = {
-                                'isin': isin,
-                                'name': name,
-                                'underlying_category': label
-                            }
-                            found += 1
+                        name = link.get_text(strip=True)
+                        if 'TURBO' in name.upper() or 'LEVA' in name.upper():
+                            continue
+                        matches.append((match.group(1).upper(), name))
             
-            self.stats['by_underlying'][label] = found
-            self.log(f"  Trovati: {found}")
-            return found
+            return matches
         except Exception as e:
             self.log(f"  Errore: {str(e)[:60]}")
-            return 0
+            return None
+
+    def add_search_results(self, label, matches):
+        """Registra i certificati nuovi; un ISIN già visto resta al primo sottostante"""
+        found = 0
+        for isin, name in matches:
+            if isin not in self.certificates:
+                self.certificates[isin] = {
+                    'isin': isin,
+                    'name': name,
+                    'underlying_category': label
+                }
+                found += 1
+        
+        self.stats['by_underlying'][label] = found
+        self.log(f"  {label} - Trovati: {found}")
+
+    async def map_pages(self, ctx, items, fn, pause):
+        """Esegue fn(page, item) per ogni item su CONCURRENCY pagine; risultati nell'ordine degli item"""
+        queue = asyncio.Queue()
+        for entry in enumerate(items):
+            queue.put_nowait(entry)
+        results = [None] * len(items)
+        
+        async def worker():
+            page = await ctx.new_page()
+            try:
+                while True:
+                    try:
+                        i, item = queue.get_nowait()
+                    except asyncio.QueueEmpty:
+                        return
+                    results[i] = await fn(page, item)
+                    await asyncio.sleep(pause)
+            finally:
+                await page.close()
+        
+        await asyncio.gather(*(worker() for _ in range(min(CONCURRENCY, len(items)))))
+        return results
 
-    async def get_detail(self, page, isin, base_data):
+    async def load_detail(self, ctx, page, url):
+        """HTML della scheda: GET diretto, rendering nel browser solo se la scheda è incompleta"""
+        html = await detail_fetcher.get(ctx, url)
+        if html is not None:
+            return html
+        
+        await page.goto(url, wait_until='networkidle', timeout=45000)
+        await asyncio.sleep(2)
+        return await page.content()
+
+    async def get_detail(self, ctx, page, isin, base_data):
         """Estrae dettagli - V11 COMPLETO"""
         url = f"https://www.certificatiederivati.it/db_bs_scheda_certificato.asp?isin={isin}"
         
         try:
-            await page.goto(url, wait_until='networkidle', timeout=45000)
-            await asyncio.sleep(2)
-            
-            html = await page.content()
+            html = await self.load_detail(ctx, page, url)
             soup = BeautifulSoup(html, 'html.parser')
             
             detail = {
@@ -302,26 +344,30 @@ class CEDScraperV11:
         async with async_playwright() as p:
             browser = await p.chromium.launch(headless=True, args=['--no-sandbox'])
             ctx = await browser.new_context(viewport={'width': 1920, 'height': 1080})
-            page = await ctx.new_page()
             
             try:
                 self.log("\n📋 FASE 1: Ricerca")
-                for value, label in TARGET_UNDERLYINGS:
-                    await self.search_underlying(page, value, label)
-                    await asyncio.sleep(2)
+                searches = await self.map_pages(
+                    ctx, TARGET_UNDERLYINGS, lambda page, item: self.search_underlying(page, *item), 2
+                )
+                # Unisci nell'ordine di TARGET_UNDERLYINGS, non in quello di arrivo
+                for (value, label), matches in zip(TARGET_UNDERLYINGS, searches):
+                    if matches is not None:
+                        self.add_search_results(label, matches)
                 
                 self.stats['found'] = len(self.certificates)
                 self.log(f"\n✅ Trovati: {len(self.certificates)}")
                 
                 if self.certificates:
                     self.log(f"\n📊 FASE 2: Dettagli")
-                    results = []
                     items = list(self.certificates.items())
-                    for i, (isin, data) in enumerate(items):
+                    
+                    async def fetch(page, item):
+                        i, (isin, data) = item
                         self.log(f"[{i+1}/{len(items)}] {isin}")
-                        detail = await self.get_detail(page, isin, data)
-                        results.append(detail)
-                        await asyncio.sleep(1.5)
+                        return await self.get_detail(ctx, page, isin, data)
+                    
+                    results = await self.map_pages(ctx, list(enumerate(items)), fetch, 1.5)
                     
                     self.certificates = {r['isin']: r for r in results}
             finally:
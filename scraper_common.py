@@ -0,0 +1,134 @@
+"""
+Helper condivisi dagli scraper CED Lab (v11, v12, v13, production_scraper.py e .py2501):
+rate limiting, blocco delle risorse nel browser, testo delle celle, cache su disco
+delle schede HTML e download con GET diretta e rendering nel browser come ripiego
+"""
+
+import asyncio
+import os
+import time
+from lxml import etree
+
+# Risorse mai lette dal parser (servono solo HTML e script inline, la barriera è nel JS).
+# "other" e "websocket" passano: i pannelli caricati via XHR resterebbero vuoti
+BLOCKED_RESOURCES = {'image', 'media', 'font', 'stylesheet', 'beacon'}
+BLOCKED_HOSTS = ('google-analytics', 'googletagmanager', 'doubleclick', 'facebook.net', 'hotjar')
+
+# Nodi di testo di una cella, esclusi script e style (come get_text di BeautifulSoup)
+CELL_TEXT_NODES = etree.XPath('.//text()[not(ancestor::script or ancestor::style)]', smart_strings=False)
+
+
+async def block_resources(route):
+    """Blocca asset e tracker, lascia passare documenti e script"""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCES or any(host in request.url for host in BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+
+def cell_text(td):
+    """Testo di una cella lxml, ripulito come get_text(strip=True) di BeautifulSoup"""
+    return ''.join(s.strip() for s in CELL_TEXT_NODES(td))
+
+
+def has_marker(*markers):
+    """Controllo di completezza: la pagina contiene almeno uno dei marker"""
+    return lambda html: any(marker in html for marker in markers)
+
+
+class RateLimiter:
+    """Distanzia le richieste al sito di 1/max_rate secondi, per tutti i worker insieme"""
+
+    def __init__(self, max_rate):
+        self.interval = 1 / max_rate
+        self.next_slot = 0.0
+
+    async def wait(self):
+        now = time.monotonic()
+        delay = self.next_slot - now
+        self.next_slot = max(now, self.next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class HtmlCache:
+    """Schede HTML su disco, un file per chiave (ISIN), valide per ttl secondi"""
+
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.html")
+
+    def get(self, key):
+        """HTML in cache per la chiave, o None se assente o più vecchio di ttl"""
+        path = self.path(key)
+        try:
+            if time.time() - os.path.getmtime(path) < self.ttl:
+                with open(path, encoding='utf-8') as f:
+                    return f.read()
+        except OSError:
+            pass
+        return None
+
+    def set(self, key, html):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self.path(key), 'w', encoding='utf-8') as f:
+            f.write(html)
+
+
+class PageFetcher:
+    """HTML di una pagina: GET diretta, rendering nel browser solo se la risposta è incompleta.
+    is_complete(html) dice se la pagina è arrivata con i dati; con una cache le pagine
+    complete sono riusate tra i run, quelle incomplete o di errore si riscaricano"""
+
+    def __init__(self, is_complete, ready_selector=None, timeout=30000, selector_timeout=5000,
+                 rate_limiter=None, cache=None):
+        self.is_complete = is_complete
+        self.ready_selector = ready_selector
+        self.timeout = timeout
+        self.selector_timeout = selector_timeout
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+
+    async def fetch(self, context, page, url, key=None):
+        if self.cache is not None and key is not None:
+            html = self.cache.get(key)
+            if html is not None:
+                return html
+
+        html = await self.get(context, url)
+        if html is None:
+            html = await self.render(page, url)
+
+        if self.cache is not None and key is not None and self.is_complete(html):
+            self.cache.set(key, html)
+        return html
+
+    async def get(self, context, url):
+        """HTML dalla GET diretta, o None se la risposta non è completa"""
+        if self.rate_limiter:
+            await self.rate_limiter.wait()
+        try:
+            response = await context.request.get(url, timeout=self.timeout)
+            if response.ok:
+                html = await response.text()
+                if self.is_complete(html):
+                    return html
+        except Exception:
+            pass  # Timeout o errore di rete: si passa al rendering nel browser
+        return None
+
+    async def render(self, page, url):
+        if self.rate_limiter:
+            await self.rate_limiter.wait()
+        await page.goto(url, timeout=self.timeout, wait_until='domcontentloaded')
+        # Attende il contenuto invece di un'attesa fissa
+        if self.ready_selector:
+            try:
+                await page.wait_for_selector(self.ready_selector, timeout=self.selector_timeout)
+            except Exception:
+                pass
+        return await page.content()